@@ -67,9 +67,13 @@ FIXME's
 """
 import re
 import sys
+import errno
+import bisect
 import logging
 import os
 import io
+import shutil
+import tempfile
 
 sys.stdin = io.TextIOWrapper(
     sys.stdin.detach(), encoding='UTF-8', line_buffering=True)
@@ -78,9 +82,9 @@ sys.stdout = io.TextIOWrapper(
 
 
 from .fparse_utils import (VAR_DECL_RE, OMP_COND_RE, OMP_DIR_RE,
-                           InputStream, CharFilter,
+                           InputStream, mask_line, filtered_spans,
                            FprettifyException, FprettifyParseException, FprettifyInternalException,
-                           CPP_RE, NOTFORTRAN_LINE_RE, NOTFORTRAN_FYPP_LINE_RE, FYPP_LINE_RE, RE_FLAGS,
+                           CPP_RE, NOTFORTRAN_LINE_RE, NOTFORTRAN_FYPP_LINE_RE, FYPP_LINE_RE, FYPP_LINE_PREFIXES, RE_FLAGS,
                            STR_OPEN_RE, parser_re, FYPP_WITHOUT_PREPRO_RE)
 
 # recognize fortran files by extension
@@ -94,8 +98,10 @@ FORMATTER_ERROR_MESSAGE = (" Wrong usage of formatting-specific directives"
 LINESPLIT_MESSAGE = ("auto indentation failed due to chars limit, "
                      "line should be split")
 
+LOGGER = logging.getLogger('fprettify-logger')
+LOGGER_HANDLER_NAME = 'fprettify-handler'
+
 EOL_STR = r"\s*;?\s*$"  # end of fortran line
-EOL_SC = r"\s*;\s*$"  # whether line is ended with semicolon
 SOL_STR = r"^\s*"  # start of fortran line
 
 STATEMENT_LABEL_RE = re.compile(r"^\s*(\d+\s)(?!"+EOL_STR+")", RE_FLAGS)
@@ -198,6 +204,12 @@ PUBLIC_RE = re.compile(SOL_STR + r"PUBLIC\s*::", RE_FLAGS)
 
 END_RE = re.compile(SOL_STR + r"(END)\s*(IF|DO|SELECT|ASSOCIATE|BLOCK|SUBROUTINE|FUNCTION|MODULE|SUBMODULE|TYPE|PROGRAM|INTERFACE|ENUM|WHERE|FORALL)", RE_FLAGS)
 
+# keywords of all statements that start, continue or end a scope
+# (coarse filter for lines that need to be checked by the scope parser)
+SCOPE_KEYWORD_RE = re.compile(
+    r"\b(IF|DO|SELECT|SUBROUTINE|FUNCTION|MODULE|SUBMODULE|PROGRAM|INTERFACE|TYPE|ENUM|"
+    r"ASSOCIATE|BLOCK|WHERE|FORALL|ELSE|CASE|RANK|CLASS|CONTAINS|END)|#:", RE_FLAGS)
+
 # intrinsic statements with parenthesis notation that are not functions
 INTR_STMTS_PAR = (r"(ALLOCATE|DEALLOCATE|"
                   r"OPEN|CLOSE|READ|WRITE|"
@@ -206,6 +218,11 @@ INTR_STMTS_PAR = (r"(ALLOCATE|DEALLOCATE|"
 
 # regular expressions for parsing linebreaks
 LINEBREAK_STR = r"(&)[\s]*(?:!.*)?$"
+LINEBREAK_RE = re.compile(LINEBREAK_STR, RE_FLAGS)
+AMPERSAND_RE = re.compile(r"&", RE_FLAGS)
+EQ_LINEBREAK_RE = re.compile(r"=>?\s*" + LINEBREAK_STR, RE_FLAGS)
+COLONCOLON_LINEBREAK_RE = re.compile(r"::\s*" + LINEBREAK_STR, RE_FLAGS)
+COLON_LINEBREAK_RE = re.compile(r":\s*" + LINEBREAK_STR, RE_FLAGS)
 
 # regular expressions for parsing operators
 # Note: +/- in real literals and sign operator is ignored
@@ -219,15 +236,53 @@ REL_OP_RE = re.compile(
     RE_FLAGS)
 LOG_OP_RE = re.compile(r"\s*(\.(?:AND|OR|EQV|NEQV)\.)\s*", RE_FLAGS)
 PRINT_RE = re.compile(r"(?:(?<=\bPRINT)|(?<=\bREAD))\s*(\*,?)\s*", RE_FLAGS)
+PLUSMINUS_OP_RE = re.compile(r"^(\+|-)$", RE_FLAGS)
+NOT_OP_RE = re.compile(r"\.NOT\.", RE_FLAGS)
+WORD_CHAR_RE = re.compile(r"\w", RE_FLAGS)
 
 # regular expressions for parsing delimiters
 DEL_OPEN_STR = r"(\(\/?|\[)"
 DEL_OPEN_RE = re.compile(r"^" + DEL_OPEN_STR, RE_FLAGS)
 DEL_CLOSE_STR = r"(\/?\)|\])"
 DEL_CLOSE_RE = re.compile(r"^" + DEL_CLOSE_STR, RE_FLAGS)
+DEL_OPEN_TOKENS = ("(", "(/", "[")
+DEL_CLOSE_TOKENS = (")", "/)", "]")
+DEL_OPEN_LINEBREAK_RE = re.compile(DEL_OPEN_STR + r"\s*" + LINEBREAK_STR, RE_FLAGS)
+DEL_CHAR_RE = re.compile(r"[()\[\]/]", RE_FLAGS)
+
+# context of delimiters that determines whether to separate them by whitespace
+# (to be matched against line up to an opening delimiter or after a closing
+# delimiter)
+PRE_DELIM_OPEN_RE = re.compile(r"(" + DEL_OPEN_STR + r"|[\w\*/=\+\-:])\s*$", RE_FLAGS)
+IF_PREFIX_RE = re.compile(SOL_STR + r"(\w+\s*:)?(ELSE)?\s*IF\s*$", RE_FLAGS)
+DO_WHILE_PREFIX_RE = re.compile(SOL_STR + r"(\w+\s*:)?\s*DO\s+WHILE\s*$", RE_FLAGS)
+CASE_PREFIX_RE = re.compile(SOL_STR + r"((SELECT)?\s*CASE|(SELECT)?\s*RANK|SELECT\s*TYPE|"
+                            r"CLASS\s*DEFAULT|(TYPE|CLASS)\s+IS)\s*$", RE_FLAGS)
+INTR_STMT_PREFIX_RE = re.compile(r"(?<!%)\b" + INTR_STMTS_PAR + r"\s*$", RE_FLAGS)
+POST_DELIM_CLOSE_RE = re.compile(r"\s*(" + DEL_CLOSE_STR + r"|[,%:/\*])", RE_FLAGS)
+POST_DOUBLECOLON_RE = re.compile(r"\s*::", RE_FLAGS)
+
+# tokens relevant for alignment of line continuations
+ALIGN_TOKEN_RE = re.compile(DEL_OPEN_STR + r"|" + DEL_CLOSE_STR + r"|[,=:]", RE_FLAGS)
+
+# characters at which charwise whitespace formatting may apply
+CHARWISE_TOKEN_RE = re.compile(r"[()\[\]/,;%:.=]", RE_FLAGS)
+# characters at which any whitespace formatting (other than removal) may apply
+FORMAT_CHAR_RE = re.compile(r"[()\[\]/,;%:.=<>+\-*]", RE_FLAGS)
 
 # empty line regex
 EMPTY_RE = re.compile(SOL_STR + r"$", RE_FLAGS)
+NONSPACE_RE = re.compile(r"[^ ]")
+SPACES_RE = re.compile(r" +")
+
+# ampersand starting a line and ampersand (with preceding whitespace)
+# ending a line
+PRE_AMPERSAND_RE = re.compile(SOL_STR + r"(&\s*)", RE_FLAGS)
+POST_AMPERSAND_RE = re.compile(r"(\s*)&[\s]*(?:!.*)?$", RE_FLAGS)
+
+# construct name / label at start of line
+CONSTRUCT_NAME_RE = re.compile(SOL_STR + r"\w+\s*:", RE_FLAGS)
+ONLY_RE = re.compile(r"(only)\s*:\s*", RE_FLAGS)
 
 PREPRO_NEW_SCOPE = [parser_re(FYPP_DEF_RE), parser_re(FYPP_IF_RE), parser_re(FYPP_FOR_RE),
                        parser_re(FYPP_BLOCK_RE), parser_re(FYPP_CALL_RE), parser_re(FYPP_MUTE_RE)]
@@ -249,7 +304,7 @@ class plusminus_parser(parser_re):
 
         # exclude splits due to '+/-' in real literals
         for n, part in enumerate(partsplit):
-            if re.search(r"^(\+|-)$", part):
+            if PLUSMINUS_OP_RE.search(part):
                 if self._re_excl.search(partsplit[n-1]):
                     if n==1: partsplit_out = [partsplit[n-1]]
                     if n + 1 >= len(partsplit) or not partsplit_out:
@@ -282,7 +337,8 @@ class where_parser(parser_re):
 
         if match:
             level = 0
-            for pos, char in CharFilter(line):
+            for token in DEL_CHAR_RE.finditer(mask_line(line)):
+                pos = token.start()
                 [what_del_open, what_del_close] = get_curr_delim(line, pos)
 
                 if what_del_open:
@@ -333,6 +389,9 @@ def build_scope_parser(fypp=True, mod=True):
 
     return parser
 
+# scope parser for lines that do not contain any scope keywords
+NO_SCOPE_PARSER = {'new': [], 'continue': [], 'end': []}
+
 # match namelist names
 NML_RE = re.compile(r"(/\w+/)", RE_FLAGS)
 # find namelists and data statements
@@ -433,6 +492,9 @@ F90_OPERATORS_RE = re.compile(r"(" + "|".join([r"\." + a + r"\." for a in (
     "neqv", "not", "or", "true"
     )]) + r")", RE_FLAGS)
 
+# split line into words (including '.' for operators) and other characters
+WORD_SPLIT_RE = re.compile(r"([^a-zA-Z0-9_.])")
+
 ## Regexp for Fortran intrinsic constants
 F90_CONSTANTS_RE = re.compile(r"\b(" + "|".join((
     ## F2003 iso_fortran_env constants.
@@ -505,8 +567,10 @@ class F90Indenter(object):
         self._scope_storage = []
         # indents for all fortran lines:
         self._indent_storage = []
-        # indents of actual lines of current fortran line
-        self._line_indents = []
+        # indents of actual lines of current fortran line, stored as
+        # indent of first line and offsets of all lines w.r.t. first line
+        self._line_indent_base = 0
+        self._line_indent_offsets = []
 
         self._parser = scope_parser
 
@@ -548,42 +612,46 @@ class F90Indenter(object):
             (PROG_RE.match(f_line) or MOD_RE.match(f_line))):
             self._indent_storage[-1] = 0
 
-        self._line_indents = [0] * len(lines)
         br_indent_list = [0] * len(lines)
 
         # local variables to avoid self hassle:
-        line_indents = self._line_indents
-
         scopes = self._scope_storage
         indents = self._indent_storage
         filename = self._filename
+        debug = LOGGER.isEnabledFor(logging.DEBUG)
 
         # check statements that start new scope
         is_new = False
         valid_new = False
 
-        f_filter = CharFilter(f_line, filter_fypp=not indent_fypp)
-        f_line_filtered = f_filter.filter_all()
+        f_line_filtered = mask_line(f_line, filter_fypp=not indent_fypp, fill='')
 
-        for new_n, newre in enumerate(self._parser['new']):
+        if SCOPE_KEYWORD_RE.search(f_line_filtered):
+            parser = self._parser
+        else:
+            parser = NO_SCOPE_PARSER
+
+        for new_n, (newre, endre) in enumerate(zip(parser['new'], parser['end'])):
             if newre and newre.search(f_line_filtered) and \
-                not self._parser['end'][new_n].search(f_line_filtered):
+                not endre.search(f_line_filtered):
                 what_new = new_n
                 is_new = True
                 valid_new = True
                 scopes.append(what_new)
-                log_message("{}: {}".format(what_new, f_line),
-                            "debug", filename, line_nr)
+                if debug:
+                    log_message("{}: {}".format(what_new, f_line),
+                                "debug", filename, line_nr)
 
         # check statements that continue scope
         is_con = False
         valid_con = False
-        for con_n, conre in enumerate(self._parser['continue']):
+        for con_n, conre in enumerate(parser['continue']):
             if conre and conre.search(f_line_filtered):
                 what_con = con_n
                 is_con = True
-                log_message("{}: {}".format(
-                    what_con, f_line), "debug", filename, line_nr)
+                if debug:
+                    log_message("{}: {}".format(
+                        what_con, f_line), "debug", filename, line_nr)
                 if len(scopes) > 0:
                     what = scopes[-1]
                     if what == what_con or indent_fypp:
@@ -592,19 +660,21 @@ class F90Indenter(object):
         # check statements that end scope
         is_end = False
         valid_end = False
-        for end_n, endre in enumerate(self._parser['end']):
+        for end_n, endre in enumerate(parser['end']):
             if endre and endre.search(f_line_filtered):
                 what_end = end_n
                 is_end = True
-                log_message("{}: {}".format(
-                    what_end, f_line), "debug", filename, line_nr)
+                if debug:
+                    log_message("{}: {}".format(
+                        what_end, f_line), "debug", filename, line_nr)
                 if len(scopes) > 0:
                     what = scopes.pop()
-                    if (what == what_end or not self._parser['end'][what_end].spec
+                    if (what == what_end or not endre.spec
                         or indent_fypp):
                         valid_end = True
-                        log_message("{}: {}".format(
-                            what_end, f_line), "debug", filename, line_nr)
+                        if debug:
+                            log_message("{}: {}".format(
+                                what_end, f_line), "debug", filename, line_nr)
                 else:
                     valid_end = True
 
@@ -634,15 +704,15 @@ class F90Indenter(object):
         else:
             br_indent_list = manual_lines_indent
 
-        for pos in range(0, len(lines) - 1):
-            line_indents[pos + 1] = br_indent_list[pos + 1]
+        line_offsets = [0] + br_indent_list[1:len(lines)]
+        line_base = 0
 
         if is_new and not is_end:
             if not valid_new:
                 log_message('invalid scope opening statement',
                             "info", filename, line_nr)
 
-            line_indents = [ind + indents[-1] for ind in line_indents]
+            line_base = indents[-1]
 
             indents.append(rel_ind + indents[-1])
 
@@ -650,13 +720,12 @@ class F90Indenter(object):
             valid = valid_con if is_con else valid_end
 
             if not valid:
-                line_indents = [ind + indents[-1] for ind in line_indents]
+                line_base = indents[-1]
                 log_message('invalid scope closing statement',
                             "info", filename, line_nr)
             else:
                 if len(indents) > 1 or self._initial:
-                    line_indents = [ind + indents[-2 + self._initial]
-                                    for ind in line_indents]
+                    line_base = indents[-2 + self._initial]
 
             if is_end and valid:
                 if len(indents) > 1:
@@ -665,13 +734,14 @@ class F90Indenter(object):
                     indents[-1] = 0
 
         else:
-            line_indents = [ind + indents[-1] for ind in line_indents]
+            line_base = indents[-1]
 
         # we have processed first line:
         self._initial = False
 
         # reassigning self.* to the updated variables
-        self._line_indents = line_indents
+        self._line_indent_base = line_base
+        self._line_indent_offsets = line_offsets
         self._scope_storage = scopes
         self._indent_storage = indents
 
@@ -681,7 +751,7 @@ class F90Indenter(object):
 
     def get_lines_indent(self):
         """after processing, retrieve the indents of all line parts."""
-        return self._line_indents
+        return [self._line_indent_base + offset for offset in self._line_indent_offsets]
 
 
 class F90Aligner(object):
@@ -758,25 +828,16 @@ class F90Aligner(object):
         # or alignment to assignment operator
         rel_ind = indent_list[-1]  # indentation of prev. line
 
-        end_of_delim = -1
-
-        for pos, char in CharFilter(line):
+        for token in ALIGN_TOKEN_RE.finditer(mask_line(line)):
+            pos = token.start()
+            char = token.group()
 
-            what_del_open = None
-            what_del_close = None
-            if pos > end_of_delim:
-                [what_del_open, what_del_close] = get_curr_delim(line, pos)
-
-            if what_del_open:
-                what_del_open = what_del_open.group()
-                end_of_delim = pos + len(what_del_open) - 1
+            if char in DEL_OPEN_TOKENS:
                 level += 1
-                indent_list.append(pos + len(what_del_open) + rel_ind)
+                indent_list.append(pos + len(char) + rel_ind)
                 pos_ldelim.append(pos)
-                ldelim.append(what_del_open)
-            if what_del_close:
-                what_del_close = what_del_close.group()
-                end_of_delim = pos + len(what_del_close) - 1
+                ldelim.append(char)
+            elif char in DEL_CLOSE_TOKENS:
                 if level > 0:
                     level += -1
                     indent_list.pop()
@@ -789,18 +850,18 @@ class F90Aligner(object):
                     what_del_open = ldelim.pop()
                     valid = False
                     if what_del_open == r"(":
-                        valid = what_del_close == r")"
+                        valid = char == r")"
                     if what_del_open == r"(/":
-                        valid = what_del_close == r"/)"
+                        valid = char == r"/)"
                     if what_del_open == r"[":
-                        valid = what_del_close == r"]"
+                        valid = char == r"]"
                     if not valid:
                         log_message('unpaired bracket delimiters',
                                     "info", filename, line_nr)
 
                 else:
                     pos_rdelim.append(pos)
-                    rdelim.append(what_del_close)
+                    rdelim.append(char)
             if char == ',' and not level and pos_eq > 0:
                 # a top level comma removes previous alignment position.
                 # (see issue #11)
@@ -816,18 +877,16 @@ class F90Aligner(object):
                 pos_eq = pos + 1
                 # don't align if assignment operator directly before
                 # line break
-                if not re.search(r"=>?\s*" + LINEBREAK_STR, line,
-                                 RE_FLAGS):
+                if not EQ_LINEBREAK_RE.search(line):
                     indent_list.append(
                         pos_eq + 1 + is_pointer + indent_list[-1])
-            elif is_decl and line[pos:pos + 2] == '::' and not re.search(r"::\s*" + LINEBREAK_STR, line, RE_FLAGS):
+            elif is_decl and line[pos:pos + 2] == '::' and not COLONCOLON_LINEBREAK_RE.search(line):
                 indent_list.append(pos + 3 + indent_list[-1])
-            elif is_use and line[pos] == ':' and not re.search(r":\s*" + LINEBREAK_STR, line, RE_FLAGS):
+            elif is_use and line[pos] == ':' and not COLON_LINEBREAK_RE.search(line):
                 indent_list.append(pos + 2 + indent_list[-1])
 
         # Don't align if delimiter opening directly before line break
-        if level and re.search(DEL_OPEN_STR + r"\s*" + LINEBREAK_STR, line,
-                               RE_FLAGS):
+        if level and DEL_OPEN_LINEBREAK_RE.search(line):
             if len(indent_list) > 1:
                 indent_list[-1] = indent_list[-2]
             else:
@@ -887,6 +946,34 @@ def inspect_ffile_format(infile, indent_size, strict_indent, indent_fypp=False,
     return indents, first_indent, has_fypp
 
 
+def split_line_parts(line):
+    """
+    Split line into parts such that code parts and strings alternate, the
+    last part may also contain comments.
+    """
+    line_parts = ['']
+    pos_prev = 0
+    for start, end in filtered_spans(line):
+        line_parts[-1] += line[pos_prev:start]
+        if end < len(line):
+            line_parts += [line[start:end].strip(), '']
+        else:
+            line_parts.append(line[start:])
+        pos_prev = end
+
+    line_parts[-1] += line[pos_prev:]
+    return line_parts
+
+
+# substitutions of relational operators, applied in this order
+REL_OP_CSTYLE_SUBS = [(re.compile(rel_re, RE_FLAGS), rel_op) for rel_re, rel_op in (
+    (r"\.LT\.", "<   "), (r"\.LE\.", "<=  "), (r"\.GT\.", ">   "),
+    (r"\.GE\.", ">=  "), (r"\.EQ\.", "==  "), (r"\.NE\.", "/=  "))]
+REL_OP_FSTYLE_SUBS = [(re.compile(rel_re, RE_FLAGS), rel_op) for rel_re, rel_op in (
+    (r"<=", ".le."), (r"<", ".lt."), (r">=", ".ge."),
+    (r">", ".gt."), (r"==", ".eq."), (r"\/=", ".ne."))]
+
+
 def replace_relational_single_fline(f_line, cstyle):
     """
     format a single Fortran line - replaces scalar relational
@@ -905,39 +992,15 @@ def replace_relational_single_fline(f_line, cstyle):
     if REL_OP_RE.search(f_line):
         # check that relation is not inside quotes, a string, or commented
         # (think of underlining a heading with === or things like markup being printed which we do not replace)
-        pos_prev = -1
-        pos = -1
-        line_parts = ['']
-        for pos, char in CharFilter(f_line):
-            if pos > pos_prev + 1: # skipped string
-                line_parts.append(f_line[pos_prev + 1:pos].strip()) # append string
-                line_parts.append('')
-
-            line_parts[-1] += char
-
-            pos_prev = pos
-
-        if pos + 1 < len(f_line):
-            line_parts.append(f_line[pos + 1:])
+        line_parts = split_line_parts(f_line)
+        rel_subs = REL_OP_CSTYLE_SUBS if cstyle else REL_OP_FSTYLE_SUBS
 
         for pos, part in enumerate(line_parts):
             # exclude comments, strings:
             if not STR_OPEN_RE.match(part):
                 # also exclude / if we see a namelist and data statement
-                if cstyle:
-                    part = re.sub(r"\.LT\.", "<   ", part, flags=RE_FLAGS)
-                    part = re.sub(r"\.LE\.", "<=  ", part, flags=RE_FLAGS)
-                    part = re.sub(r"\.GT\.", ">   ", part, flags=RE_FLAGS)
-                    part = re.sub(r"\.GE\.", ">=  ", part, flags=RE_FLAGS)
-                    part = re.sub(r"\.EQ\.", "==  ", part, flags=RE_FLAGS)
-                    part = re.sub(r"\.NE\.", "/=  ", part, flags=RE_FLAGS)
-                else:
-                    part = re.sub(r"<=",  ".le.", part, flags=RE_FLAGS)
-                    part = re.sub(r"<",   ".lt.", part, flags=RE_FLAGS)
-                    part = re.sub(r">=",  ".ge.", part, flags=RE_FLAGS)
-                    part = re.sub(r">",   ".gt.", part, flags=RE_FLAGS)
-                    part = re.sub(r"==",  ".eq.", part, flags=RE_FLAGS)
-                    part = re.sub(r"\/=", ".ne.", part, flags=RE_FLAGS)
+                for rel_re, rel_op in rel_subs:
+                    part = rel_re.sub(rel_op, part)
 
             line_parts[pos] = part
 
@@ -954,29 +1017,16 @@ def replace_keywords_single_fline(f_line, case_dict):
     new_line = f_line
 
     # Collect words list
-    pos_prev = -1
-    pos = -1
-    line_parts = ['']
-    for pos, char in CharFilter(f_line):
-        if pos > pos_prev + 1: # skipped string
-            line_parts.append(f_line[pos_prev + 1:pos].strip()) # append string
-            line_parts.append('')
+    line_parts = split_line_parts(f_line)
 
-        line_parts[-1] += char
-
-        pos_prev = pos
-
-    if pos + 1 < len(f_line):
-        line_parts.append(f_line[pos + 1:])
-
-    line_parts = [[a] if STR_OPEN_RE.match(a) else re.split(F90_OPERATORS_RE,a)
+    line_parts = [[a] if STR_OPEN_RE.match(a) else F90_OPERATORS_RE.split(a)
                   for a in line_parts]  # problem, split "."
     line_parts = [b for a in line_parts for b in a]
 
     ## line_parts = [[a] if STR_OPEN_RE.match(a) else re.split('(\W)',a)
     ##               for a in line_parts]  # problem, split "."
     line_parts = [[a] if STR_OPEN_RE.match(a)
-                  else re.split('([^a-zA-Z0-9_.])',a)
+                  else WORD_SPLIT_RE.split(a)
                   for a in line_parts]
     line_parts = [b for a in line_parts for b in a]
 
@@ -1015,6 +1065,30 @@ def replace_keywords_single_fline(f_line, case_dict):
     return new_line
 
 
+# position of whitespace settings in 'spacey' list
+WHITESPACE_MAPPING = {
+    'comma': 0,           # 0: comma, semicolon
+    'assignments': 1,     # 1: assignment operators
+    'relational': 2,      # 2: relational operators
+    'logical': 3,         # 3: logical operators
+    'plusminus': 4,       # 4: arithm. operators plus and minus
+    'multdiv': 5,         # 5: arithm. operators multiply and divide
+    'print': 6,           # 6: print / read statements
+    'type': 7,            # 7: select type components
+    'intrinsics': 8,      # 8: intrinsics
+    'decl': 9             # 9: declarations
+    }
+
+# 'spacey' settings for each whitespace level
+WHITESPACE_LEVELS = {
+    0: (0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+    1: (1, 1, 1, 1, 0, 0, 1, 0, 1, 1),
+    2: (1, 1, 1, 1, 1, 0, 1, 0, 1, 1),
+    3: (1, 1, 1, 1, 1, 1, 1, 0, 1, 1),
+    4: (1, 1, 1, 1, 1, 1, 1, 1, 1, 1)
+    }
+
+
 def format_single_fline(f_line, whitespace, whitespace_dict, linebreak_pos,
                         ampersand_sep, scope_parser, format_decl, filename, line_nr,
                         auto_format=True):
@@ -1033,35 +1107,13 @@ def format_single_fline(f_line, whitespace, whitespace_dict, linebreak_pos,
     """
 
     # define whether to put whitespaces around operators:
-    mapping = {
-            'comma': 0,           # 0: comma, semicolon
-            'assignments': 1,     # 1: assignment operators
-            'relational': 2,      # 2: relational operators
-            'logical': 3,         # 3: logical operators
-            'plusminus': 4,       # 4: arithm. operators plus and minus
-            'multdiv': 5,         # 5: arithm. operators multiply and divide
-            'print': 6,           # 6: print / read statements
-            'type': 7,            # 7: select type components
-            'intrinsics': 8,      # 8: intrinsics
-            'decl': 9             # 9: declarations
-            }
-
-    if whitespace == 0:
-        spacey = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    elif whitespace == 1:
-        spacey = [1, 1, 1, 1, 0, 0, 1, 0, 1, 1]
-    elif whitespace == 2:
-        spacey = [1, 1, 1, 1, 1, 0, 1, 0, 1, 1]
-    elif whitespace == 3:
-        spacey = [1, 1, 1, 1, 1, 1, 1, 0, 1, 1]
-    elif whitespace == 4:
-        spacey = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
-    else:
+    if whitespace not in WHITESPACE_LEVELS:
         raise NotImplementedError("unknown value for whitespace")
+    spacey = list(WHITESPACE_LEVELS[whitespace])
 
     if whitespace_dict:
         # iterate over dictionary and override settings for 'spacey'
-        for key, value in mapping.items():
+        for key, value in WHITESPACE_MAPPING.items():
             if whitespace_dict[key] == True:
                 spacey[value] = 1
             elif whitespace_dict[key] == False:
@@ -1073,8 +1125,11 @@ def format_single_fline(f_line, whitespace, whitespace_dict, linebreak_pos,
     if auto_format:
 
         line = rm_extra_whitespace(line, format_decl)
-        line = add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, line_nr)
-        line = add_whitespace_context(line, spacey)
+        # lines without operators, delimiters or END statements (e.g. a bare
+        # CONTAINS or IMPLICIT NONE) need no further formatting
+        if FORMAT_CHAR_RE.search(line) or END_RE.search(line):
+            line = add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, line_nr)
+            line = add_whitespace_context(line, spacey)
 
     lines_out = split_reformatted_line(
         line_orig, linebreak_pos, ampersand_sep, line, filename, line_nr)
@@ -1083,43 +1138,88 @@ def format_single_fline(f_line, whitespace, whitespace_dict, linebreak_pos,
 
 def rm_extra_whitespace(line, format_decl):
     """rm all unneeded whitespace chars, except for declarations"""
-    line_ftd = ''
-    pos_prev = -1
-    pos = -1
-    for pos, char in CharFilter(line):
-        if format_decl:
-            is_decl = False
-        else:
-            is_decl = line[pos:].lstrip().startswith('::') or line[
-                :pos].rstrip().endswith('::')
-
-        if pos > pos_prev + 1: # skipped string
-            line_ftd = line_ftd + line[pos_prev + 1:pos]
-
-        if char == ' ':
-            # remove double spaces:
-            if line_ftd and (re.search(r'[\w]', line_ftd[-1]) or is_decl):
-                line_ftd = line_ftd + char
-        else:
-            if (line_ftd and line_ftd[-1] == ' ' and
-                    (not re.search(r'[\w]', char) and not is_decl)):
-                line_ftd = line_ftd[:-1]  # remove spaces except between words
-            line_ftd = line_ftd + char
-        pos_prev = pos
-
-    line_ftd = line_ftd + line[pos+1:]
-    return line_ftd
+    check_decl = not format_decl and '::' in line
+    parts = []
+    pos_copied = 0
+    pos_code = 0
+    for start, end in filtered_spans(line) + [(len(line), len(line))]:
+        for spaces in SPACES_RE.finditer(line, pos_code, start):
+            pos, pos_end = spaces.span()
+            if pos > 0 and check_decl:
+                # keep whitespace around '::' of declarations
+                if POST_DOUBLECOLON_RE.match(line, pos_end):
+                    continue
+                pos_prev = pos
+                while pos_prev > 0 and line[pos_prev - 1].isspace():
+                    pos_prev -= 1
+                if line.endswith('::', 0, pos_prev):
+                    continue
+            parts.append(line[pos_copied:pos])
+            pos_copied = pos_end
+            # keep one space between words (or before strings)
+            if pos > 0 and WORD_CHAR_RE.match(line[pos - 1]) and (
+                    pos_end == start or WORD_CHAR_RE.match(line[pos_end])):
+                parts.append(' ')
+        pos_code = end
+
+    parts.append(line[pos_copied:])
+    return ''.join(parts)
 
 
 def add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, line_nr):
     """add whitespace character wise (no need for context aware parsing)"""
-    line_ftd = line
+    # the formatted line is assembled from a list of parts, each token is
+    # inserted together with its separating whitespace after stripping
+    # whitespace characters on both sides of the token.
+    parts = []
+    pos_copied = 0  # position in unformatted line up to which parts are filled
+    lstrip_next = False  # whether to strip whitespace before next part
+    rstrip_end = False  # whether to strip whitespace at the end of the line
+    ftd_len = 0  # length of formatted line assembled in parts
+
+    def rstrip_parts():
+        nonlocal ftd_len
+        while parts:
+            part = parts[-1].rstrip(' ')
+            ftd_len -= len(parts[-1]) - len(part)
+            parts[-1] = part
+            if part:
+                break
+            parts.pop()
+
+    def insert_token(pos, token, sep1, sep2, rstrip=False):
+        """replace token of unformatted line at `pos`"""
+        nonlocal pos_copied, lstrip_next, rstrip_end, ftd_len
+        lhs = line[pos_copied:pos]
+        if lstrip_next:
+            lhs = lhs.lstrip(' ')
+        lhs = lhs.rstrip(' ')
+        if lhs:
+            parts.append(lhs)
+            ftd_len += len(lhs)
+        else:
+            rstrip_parts()
+        part = ' ' * sep1 + token + ' ' * sep2
+        parts.append(part)
+        ftd_len += len(part)
+        pos_copied = pos + len(token)
+        lstrip_next = True
+
+        if rstrip:
+            if line[pos_copied:].strip(' '):
+                rstrip_end = True
+            else:
+                rstrip_parts()
+                pos_copied = len(line)
+
     pos_eq = []
     end_of_delim = -1
     level = 0
-    for pos, char in CharFilter(line):
-        # offset w.r.t. unformatted line
-        offset = len(line_ftd) - len(line)
+    for token in CHARWISE_TOKEN_RE.finditer(mask_line(line)):
+        pos = token.start()
+        if pos < pos_copied:
+            continue
+        char = token.group()
 
         # format delimiters
         what_del_open = None
@@ -1136,9 +1236,6 @@ def add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, l
             else:
                 delim = what_del_close.group()
 
-            lhs = line_ftd[:pos + offset]
-            rhs = line_ftd[pos + len(delim) + offset:]
-
             # format opening delimiters
             if what_del_open:
                 level += 1  # new scope
@@ -1146,26 +1243,12 @@ def add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, l
                 # with some exceptions:
                 # FIXME: duplication of regex, better to include them into
                 # INTR_STMTS_PAR
-                if ((not re.search((r"(" + DEL_OPEN_STR +
-                                    r"|[\w\*/=\+\-:])\s*$"),
-                                   line[:pos], RE_FLAGS) and
-                     not EMPTY_RE.search(line[:pos])) or
-                        re.search(SOL_STR + r"(\w+\s*:)?(ELSE)?\s*IF\s*$",
-                                  line[:pos], RE_FLAGS) or
-                        re.search(SOL_STR + r"(\w+\s*:)?\s*DO\s+WHILE\s*$",
-                                  line[:pos], RE_FLAGS) or
-                        re.search(SOL_STR + r"(SELECT)?\s*CASE\s*$",
-                                  line[:pos], RE_FLAGS) or
-                        re.search(SOL_STR + r"(SELECT)?\s*RANK\s*$",
-                                  line[:pos], RE_FLAGS) or
-                        re.search(SOL_STR + r"SELECT\s*TYPE\s*$",
-                                  line[:pos], RE_FLAGS) or
-                        re.search(SOL_STR + r"CLASS\s*DEFAULT\s*$",
-                                  line[:pos], RE_FLAGS) or
-                        re.search(SOL_STR + r"(TYPE|CLASS)\s+IS\s*$",
-                                  line[:pos], RE_FLAGS) or
-                        re.search(r"(?<!%)\b" + INTR_STMTS_PAR + r"\s*$",
-                                  line[:pos], RE_FLAGS)):
+                if ((not PRE_DELIM_OPEN_RE.search(line, 0, pos) and
+                     not EMPTY_RE.search(line, 0, pos)) or
+                        IF_PREFIX_RE.search(line, 0, pos) or
+                        DO_WHILE_PREFIX_RE.search(line, 0, pos) or
+                        CASE_PREFIX_RE.search(line, 0, pos) or
+                        INTR_STMT_PREFIX_RE.search(line, 0, pos)):
                     sep1 = 1 * spacey[8]
 
             # format closing delimiters
@@ -1178,63 +1261,49 @@ def add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, l
 
                 # add separating whitespace after closing delimiter
                 # with some exceptions:
-                if not re.search(r"^\s*(" + DEL_CLOSE_STR + r"|[,%:/\*])",
-                                 line[pos + 1:], RE_FLAGS):
+                if not POST_DELIM_CLOSE_RE.match(line, pos + 1):
                     sep2 = 1
-                elif re.search(r"^\s*::", line[pos + 1:], RE_FLAGS):
+                elif POST_DOUBLECOLON_RE.match(line, pos + 1):
+                    rhs = line[pos + len(delim):]
                     sep2 = len(rhs) - len(rhs.lstrip(' ')) if not format_decl else 1
 
             # where delimiter token ends
             end_of_delim = pos + len(delim) - 1
 
-            line_ftd = lhs.rstrip(' ') + ' ' * sep1 + \
-                delim + ' ' * sep2 + rhs.lstrip(' ')
+            insert_token(pos, delim, sep1, sep2)
 
         # format commas and semicolons
-        if char in [',', ';']:
-            lhs = line_ftd[:pos + offset]
-            rhs = line_ftd[pos + 1 + offset:]
-            line_ftd = lhs.rstrip(' ') + char + ' ' * \
-                spacey[0] + rhs.lstrip(' ')
-            line_ftd = line_ftd.rstrip(' ')
+        elif char in [',', ';']:
+            insert_token(pos, char, 0, spacey[0], rstrip=True)
 
         # format type selector %
-        if char == "%":
-            lhs = line_ftd[:pos + offset]
-            rhs = line_ftd[pos + 1 + offset:]
-            line_ftd = lhs.rstrip(' ') \
-                    + ' ' * spacey[7] \
-                    + char \
-                    + ' ' * spacey[7] \
-                    + rhs.lstrip(' ')
-            line_ftd = line_ftd.rstrip(' ')
+        elif char == "%":
+            insert_token(pos, char, spacey[7], spacey[7], rstrip=True)
 
         # format '::'
-        if format_decl and line[pos:pos+2] == "::":
-            lhs = line_ftd[:pos + offset]
-            rhs = line_ftd[pos + 2 + offset:]
-            line_ftd = lhs.rstrip(' ') \
-                    + ' ' * spacey[9] \
-                    + '::' + ' ' * spacey[9] \
-                    + rhs.lstrip(' ')
-            line_ftd = line_ftd.rstrip(' ')
+        elif format_decl and line[pos:pos+2] == "::":
+            insert_token(pos, '::', spacey[9], spacey[9], rstrip=True)
 
         # format .NOT.
-        if re.search(r"^\.NOT\.", line[pos:pos + 5], RE_FLAGS):
-            lhs = line_ftd[:pos + offset]
-            rhs = line_ftd[pos + 5 + offset:]
-            line_ftd = lhs.rstrip(
-                ' ') + line[pos:pos + 5] + ' ' * spacey[3] + rhs.lstrip(' ')
+        elif NOT_OP_RE.match(line, pos):
+            insert_token(pos, line[pos:pos + 5], 0, spacey[3])
 
         # strip whitespaces from '=' and prepare assignment operator
         # formatting:
-        if char == '=' and not REL_OP_RE.search(line[pos - 1:pos + 2]):
-            lhs = line_ftd[:pos + offset]
-            rhs = line_ftd[pos + 1 + offset:]
-            line_ftd = lhs.rstrip(' ') + '=' + rhs.lstrip(' ')
+        elif char == '=' and not REL_OP_RE.search(line[pos - 1:pos + 2]):
+            insert_token(pos, '=', 0, 0)
             is_pointer = line[pos + 1] == '>'
             if (not level) or is_pointer:  # remember position of assignment operator
-                pos_eq.append(len(lhs.rstrip(' ')))
+                pos_eq.append(ftd_len - 1)
+
+    rhs = line[pos_copied:]
+    if lstrip_next:
+        rhs = rhs.lstrip(' ')
+    if rstrip_end:
+        rhs = rhs.rstrip(' ')
+    parts.append(rhs)
+
+    line_ftd = ''.join(parts)
 
     line = line_ftd
 
@@ -1273,23 +1342,12 @@ def add_whitespace_context(line, spacey):
     """
 
 
-    pos_prev = -1
-    pos = -1
-    line_parts = ['']
-    for pos, char in CharFilter(line):
-        if pos > pos_prev + 1: # skipped string
-            line_parts.append(line[pos_prev + 1:pos].strip()) # append string
-            line_parts.append('')
-
-        line_parts[-1] += char
-
-        pos_prev = pos
+    line_parts = split_line_parts(line)
 
-    if pos + 1 < len(line):
-        line_parts.append(line[pos + 1:])
+    is_nml = NML_STMT_RE.match(line)
 
     # format namelists with spaces around /
-    if NML_STMT_RE.match(line):
+    if is_nml:
         for pos, part in enumerate(line_parts):
             # exclude comments, strings:
             if not STR_OPEN_RE.match(part):
@@ -1297,25 +1355,25 @@ def add_whitespace_context(line, spacey):
                 line_parts[pos] = (' '.join(partsplit))
 
     # Two-sided operators
-    for n_op, lr_re in enumerate(LR_OPS_RE):
+    # (exclude / if we see a namelist and data statement)
+    if not (is_nml or DATA_STMT_RE.match(line)):
+        lr_ops = [(lr_re, ' ' * spacey[n_op + 2]) for n_op, lr_re in enumerate(LR_OPS_RE)]
         for pos, part in enumerate(line_parts):
             # exclude comments, strings:
             if not STR_OPEN_RE.match(part):
-                # also exclude / if we see a namelist and data statement
-                if not ( NML_STMT_RE.match(line) or DATA_STMT_RE.match(line) ):
-                    partsplit = lr_re.split(part)
-                    line_parts[pos] = (' ' * spacey[n_op + 2]).join(partsplit)
+                for lr_re, sep in lr_ops:
+                    part = sep.join(lr_re.split(part))
+                line_parts[pos] = part
 
     line = ''.join(line_parts)
 
     for newre in [IF_RE, DO_RE, BLK_RE]:
-        if newre.search(line) and re.search(SOL_STR + r"\w+\s*:", line):
+        if newre.search(line) and CONSTRUCT_NAME_RE.search(line):
             line = ': '.join(_.strip() for _ in line.split(':', 1))
 
     # format ':' for labels and use only statements
     if USE_RE.search(line):
-        line = re.sub(r'(only)\s*:\s*', r'\g<1>:' + ' ' *
-                      spacey[0], line, flags=RE_FLAGS)
+        line = ONLY_RE.sub(r'\g<1>:' + ' ' * spacey[0], line)
 
     return line
 
@@ -1325,32 +1383,24 @@ def split_reformatted_line(line_orig, linebreak_pos_orig, ampersand_sep, line, f
     Infer linebreak positions of formatted line from linebreak positions in
     original line and split line.
     """
-    # shift line break positions from original to reformatted line
-    pos_new = 0
-    pos_old = 0
-    linebreak_pos_orig.sort(reverse=True)
-    linebreak_pos_ftd = []
-    while 1:
+    # shift line break positions from original to reformatted line:
+    # the n-th non-whitespace characters of both lines correspond to each
+    # other (and so do the first characters)
+    pos_old = [0] + [m.start() for m in NONSPACE_RE.finditer(line_orig, 1)] if line_orig else []
+    pos_new = [0] + [m.start() for m in NONSPACE_RE.finditer(line, 1)] if line else []
+    n_pos = min(len(pos_old), len(pos_new))
+
+    if (line_orig[:1] + line_orig[1:].replace(' ', ''))[:n_pos] != \
+            (line[:1] + line[1:].replace(' ', ''))[:n_pos]:
+        raise FprettifyInternalException(
+            "failed at finding line break position", filename, line_nr)
 
-        if pos_new == len(line) or pos_old == len(line_orig):
+    linebreak_pos_ftd = []
+    for linebreak in sorted(linebreak_pos_orig):
+        n_char = bisect.bisect_right(pos_old, linebreak, 0, n_pos)
+        if n_char == n_pos:
             break
-
-        if line[pos_new] != line_orig[pos_old]:
-            raise FprettifyInternalException(
-                "failed at finding line break position", filename, line_nr)
-
-        if linebreak_pos_orig and pos_old > linebreak_pos_orig[-1]:
-            linebreak_pos_orig.pop()
-            linebreak_pos_ftd.append(pos_new)
-            continue
-
-        pos_new += 1
-        while pos_new < len(line) and line[pos_new] == ' ':
-            pos_new += 1
-
-        pos_old += 1
-        while pos_old < len(line_orig) and line_orig[pos_old] == ' ':
-            pos_old += 1
+        linebreak_pos_ftd.append(pos_new[n_char])
 
     linebreak_pos_ftd.insert(0, 0)
 
@@ -1378,43 +1428,80 @@ def diff(a, b, a_name, b_name):
         difflib.unified_diff(a_lines, b_lines, fromfile=a_name, tofile=b_name, n=5)
     )
 
+def replace_file_contents(filename, contents):
+    """
+    write contents to file. The file is atomically replaced by a temporary
+    file if possible, otherwise (if this would change its owner or group or
+    break hard links, or if no temporary file can be created) it is
+    overwritten in place.
+    """
+    target = os.path.realpath(filename)
+    # replacing the file only requires write access to its directory, so
+    # check access to the file itself as before
+    if not os.access(target, os.W_OK):
+        raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), filename)
+
+    target_stat = os.stat(target)
+    tmpname = None
+    if target_stat.st_nlink == 1 and (not hasattr(os, 'getuid') or target_stat.st_uid == os.getuid()):
+        try:
+            # created exclusively, so an existing file or symlink is never used
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(target),
+                                           prefix=os.path.basename(target) + '.',
+                                           suffix='.fprettify.tmp')
+        except OSError:
+            # e.g. no write access to directory
+            tmpname = None
+
+    if tmpname:
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as outfile:
+                outfile.write(contents)
+            shutil.copymode(target, tmpname)
+            keep_group = True
+            if os.stat(tmpname).st_gid != target_stat.st_gid:
+                try:
+                    os.chown(tmpname, -1, target_stat.st_gid)
+                except OSError:
+                    # not member of the group: write in place instead
+                    keep_group = False
+            if keep_group:
+                os.replace(tmpname, target)
+                return
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    with io.open(target, 'w', encoding='utf-8') as outfile:
+        outfile.write(contents)
+
+
 def reformat_inplace(filename, stdout=False, diffonly=False, **kwargs):  # pragma: no cover
     """reformat a file in place."""
     if filename == '-':
-        infile = io.StringIO()
-        infile.write(sys.stdin.read())
+        old_contents = sys.stdin.read()
     else:
-        infile = io.open(filename, 'r', encoding='utf-8')
+        with io.open(filename, 'r', encoding='utf-8') as oldfile:
+            old_contents = oldfile.read()
 
+    # formatted output is accumulated in memory and written in one go
     newfile = io.StringIO()
-    reformat_ffile(infile, newfile,
+    reformat_ffile(io.StringIO(old_contents), newfile,
                    orig_filename=filename, **kwargs)
+    new_contents = newfile.getvalue()
 
     if diffonly:
-        infile.seek(0)
-        newfile.seek(0)
-        diff_contents=diff(infile.read(),newfile.read(),filename,filename)
+        diff_contents=diff(old_contents,new_contents,filename,filename)
         sys.stdout.write(diff_contents)
     else:
 
         if stdout:
-            sys.stdout.write(newfile.getvalue())
+            sys.stdout.write(new_contents)
         else:
-            outfile = io.open(filename, 'r', encoding='utf-8')
-
             # write to outfile only if content has changed
+            if new_contents != old_contents:
+                replace_file_contents(filename, new_contents)
 
-            import hashlib
-            hash_new = hashlib.md5()
-            hash_new.update(newfile.getvalue().encode('utf-8'))
-            hash_old = hashlib.md5()
-            hash_old.update(outfile.read().encode('utf-8'))
-
-            outfile.close()
-
-            if hash_new.digest() != hash_old.digest():
-                outfile = io.open(filename, 'w', encoding='utf-8')
-                outfile.write(newfile.getvalue())
 
 def reformat_ffile(infile, outfile, impose_indent=True, indent_size=3, strict_indent=False, impose_whitespace=True,
                    case_dict={},
@@ -1469,16 +1556,18 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
     if not orig_filename:
         orig_filename = infile.name
 
-    if not impose_indent:
-        indent_fypp = False
+    if impose_indent:
+        infile.seek(0)
+        req_indents, first_indent, has_fypp = inspect_ffile_format(
+            infile, indent_size, strict_indent, indent_fypp, orig_filename)
 
+        if not has_fypp: indent_fypp = False
+    else:
+        # file inspection is only needed for indentation
+        req_indents, first_indent = [], 0
+        indent_fypp = False
 
     infile.seek(0)
-    req_indents, first_indent, has_fypp = inspect_ffile_format(
-        infile, indent_size, strict_indent, indent_fypp, orig_filename)
-    infile.seek(0)
-
-    if not has_fypp: indent_fypp = False
 
     scope_parser = build_scope_parser(fypp=indent_fypp, mod=indent_mod)
 
@@ -1493,11 +1582,17 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
 
     if impose_indent:
         indenter = F90Indenter(scope_parser, first_indent, indent_size, orig_filename)
+        n_req_indents = len(req_indents)
     else:
         indent_special = 3
 
     impose_case = not all(v == 0 for v in case_dict.values())
 
+    # formatted lines of repeated statements are reused, unless formatting
+    # messages (that would not be repeated) are shown
+    cache_flines = not LOGGER.isEnabledFor(logging.INFO)
+    fline_cache = {}
+
     nfl = 0  # fortran line counter
     use_same_line = False
     stream = InputStream(infile, not indent_fypp, orig_filename=orig_filename)
@@ -1511,6 +1606,7 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
             break
 
         nfl += 1
+        line_nr = stream.line_nr
         orig_lines = lines
 
         f_line, lines, is_omp_conditional = preprocess_omp(
@@ -1525,10 +1621,10 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
         comment_lines = format_comments(lines, comments, strip_comments)
 
         auto_align, auto_format, in_format_off_block = parse_fprettify_directives(
-            lines, comment_lines, in_format_off_block, orig_filename, stream.line_nr)
+            lines, comment_lines, in_format_off_block, orig_filename, line_nr)
 
         lines, do_format, prev_indent, is_blank, is_special = preprocess_line(
-            f_line, lines, comments, orig_filename, stream.line_nr, indent_fypp)
+            f_line, lines, comments, orig_filename, line_nr, indent_fypp)
 
         if is_special[0]:
             indent_special = 3
@@ -1552,7 +1648,7 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
                 manual_lines_indent = []
 
             lines, pre_ampersand, ampersand_sep = remove_pre_ampersands(
-                lines, is_special, orig_filename, stream.line_nr)
+                lines, is_special, orig_filename, line_nr)
 
             linebreak_pos = get_linebreak_pos(lines, filter_fypp=not indent_fypp)
 
@@ -1565,19 +1661,25 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
                 f_line = replace_keywords_single_fline(f_line, case_dict)
 
             if impose_whitespace:
-                lines = format_single_fline(
-                    f_line, whitespace, whitespace_dict, linebreak_pos, ampersand_sep,
-                    scope_parser, format_decl, orig_filename, stream.line_nr, auto_format)
+                fline_key = (f_line, tuple(linebreak_pos), tuple(ampersand_sep), auto_format)
+                if fline_key in fline_cache:
+                    lines = list(fline_cache[fline_key])
+                else:
+                    lines = format_single_fline(
+                        f_line, whitespace, whitespace_dict, linebreak_pos, ampersand_sep,
+                        scope_parser, format_decl, orig_filename, line_nr, auto_format)
+                    if cache_flines:
+                        fline_cache[fline_key] = tuple(lines)
 
                 lines = append_comments(lines, comment_lines, is_special)
 
-            # target indent for next line
-            rel_indent = req_indents[nfl] if nfl < len(req_indents) else 0
-
             if indent_special != 3:
+                # target indent for next line
+                rel_indent = req_indents[nfl] if nfl < n_req_indents else 0
+
                 indenter.process_lines_of_fline(
                     f_line, lines, rel_indent, indent_size,
-                    stream.line_nr, indent_fypp, manual_lines_indent)
+                    line_nr, indent_fypp, manual_lines_indent)
                 indent = indenter.get_lines_indent()
 
             lines, indent = prepend_ampersands(lines, indent, pre_ampersand)
@@ -1585,8 +1687,9 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
         if any(is_special):
             for pos, line in enumerate(lines):
                 if is_special[pos]:
-                    indent[pos] = len(line) - len(line.lstrip(' '))
-                    lines[pos] = line.lstrip(' ')
+                    line_strip = line.lstrip(' ')
+                    indent[pos] = len(line) - len(line_strip)
+                    lines[pos] = line_strip
 
         lines = remove_trailing_whitespace(lines)
 
@@ -1596,7 +1699,7 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
                 indent = [ind + len(label) - indent[0] for ind in indent]
 
         write_formatted_line(outfile, indent, lines, orig_lines, indent_special, llength,
-                             use_same_line, is_omp_conditional, label, orig_filename, stream.line_nr)
+                             use_same_line, is_omp_conditional, label, orig_filename, line_nr)
 
         do_indent, use_same_line = pass_defaults_to_next_line(f_line)
 
@@ -1607,8 +1710,7 @@ def reformat_ffile_combined(infile, outfile, impose_indent=True, indent_size=3,
                 indent_special = 1
 
         # rm subsequent blank lines
-        skip_blank = EMPTY_RE.search(
-            f_line) and not any(comments) and not is_omp_conditional and not label
+        skip_blank = is_blank and not is_omp_conditional and not label
 
 
 def format_comments(lines, comments, strip_comments):
@@ -1661,10 +1763,17 @@ def parse_fprettify_directives(lines, comment_lines, in_format_off_block, filena
 def preprocess_omp(f_line, lines):
     """convert omp conditional to normal fortran"""
 
-    is_omp_conditional = bool(OMP_COND_RE.search(f_line))
+    match = OMP_COND_RE.match(f_line)
+    is_omp_conditional = bool(match)
     if is_omp_conditional:
-        f_line = OMP_COND_RE.sub('   ', f_line, count=1)
-        lines = [OMP_COND_RE.sub('   ', l, count=1) for l in lines]
+        f_line = '   ' + f_line[match.end():]
+        lines_out = []
+        for line in lines:
+            match = OMP_COND_RE.match(line)
+            if match:
+                line = '   ' + line[match.end():]
+            lines_out.append(line)
+        lines = lines_out
 
     return [f_line, lines, is_omp_conditional]
 
@@ -1697,14 +1806,14 @@ def preprocess_line(f_line, lines, comments, filename, line_nr, indent_fypp):
         line_strip = line.lstrip()
         if indent_fypp:
             is_special[pos] = line_strip.startswith('!!') or \
-                              (FYPP_LINE_RE.search(line_strip) if pos > 0 else False)
+                              (pos > 0 and line_strip.startswith(FYPP_LINE_PREFIXES))
         else:
-            is_special[pos] = FYPP_LINE_RE.search(line_strip) or line_strip.startswith('!!')
+            is_special[pos] = line_strip.startswith(FYPP_LINE_PREFIXES) or line_strip.startswith('!!')
 
     # if first line is special, all lines should be special
     if is_special[0]: is_special = [True]*len(lines)
 
-    if EMPTY_RE.search(f_line):  # empty lines including comment lines
+    if not f_line.strip():  # empty lines including comment lines
         if any(comments):
             if lines[0].startswith(' ') and not OMP_DIR_RE.search(lines[0]):
                 # indent comment lines only if they were not indented before.
@@ -1720,7 +1829,7 @@ def preprocess_line(f_line, lines, comments, filename, line_nr, indent_fypp):
 
 def pass_defaults_to_next_line(f_line):
     """defaults to be transferred from f_line to next line"""
-    if re.search(r";\s*$", f_line, RE_FLAGS):
+    if f_line.rstrip().endswith(';'):
         # if line ended with semicolon, don't indent next line
         do_indent = False
         use_same_line = True
@@ -1733,9 +1842,13 @@ def pass_defaults_to_next_line(f_line):
 
 def remove_trailing_whitespace(lines):
     """remove trailing whitespaces from lines"""
-    lines = [re.sub(r"\s+$", '\n', l, RE_FLAGS)
-             for l in lines]
-    return lines
+    lines_out = []
+    for line in lines:
+        line_rstrip = line.rstrip()
+        if len(line_rstrip) != len(line):
+            line = line_rstrip + '\n'
+        lines_out.append(line)
+    return lines_out
 
 
 def prepend_ampersands(lines, indent, pre_ampersand):
@@ -1756,7 +1869,7 @@ def append_comments(lines, comment_lines, is_special):
             has_nl = True  # has next line
             if not line.strip() and not is_special[pos]: comment = comment.lstrip()
         else:
-            has_nl = not re.search(EOL_SC, line)
+            has_nl = not line.rstrip().endswith(';')
         lines[pos] = lines[pos].rstrip(' ') + comment + '\n' * has_nl
 
     return lines
@@ -1770,18 +1883,17 @@ def get_linebreak_pos(lines, filter_fypp=True):
     else:
         notfortran_re = NOTFORTRAN_FYPP_LINE_RE
 
+    offset = -1
     for line in lines:
         found = None
-        for char_pos, _ in CharFilter(line, filter_strings=False):
-            if re.match(LINEBREAK_STR, line[char_pos:], RE_FLAGS):
-                found = char_pos
+        for amp in AMPERSAND_RE.finditer(mask_line(line, filter_strings=False)):
+            if LINEBREAK_RE.match(line, amp.start()):
+                found = amp.start()
         if found:
-            linebreak_pos.append(found)
+            offset += found
+            linebreak_pos.append(offset)
         elif notfortran_re.search(line.lstrip(' ')):
-            linebreak_pos.append(0)
-
-    linebreak_pos = [sum(linebreak_pos[0:_ + 1]) -
-                     1 for _ in range(0, len(linebreak_pos))]
+            linebreak_pos.append(offset)
 
     return linebreak_pos
 
@@ -1801,13 +1913,14 @@ def remove_pre_ampersands(lines, is_special, filename, line_nr):
     """
     pre_ampersand = []
     ampersand_sep = []
+    lines_out = []
 
-    for pos, line in enumerate(lines):
-        match = re.search(SOL_STR + r'(&\s*)', line)
+    for pos, (line, special) in enumerate(zip(lines, is_special)):
+        match = PRE_AMPERSAND_RE.search(line)
         if match:
             pre_ampersand.append(match.group(1))
             # amount of whitespace before ampersand of previous line:
-            m = re.search(r'(\s*)&[\s]*(?:!.*)?$', lines[pos - 1])
+            m = POST_AMPERSAND_RE.search(lines[pos - 1])
             if not m:
                 raise FprettifyParseException(
                     "Bad continuation line format", filename, line_nr)
@@ -1820,63 +1933,67 @@ def remove_pre_ampersands(lines, is_special, filename, line_nr):
                 # use default 1 whitespace character before ampersand
                 ampersand_sep.append(1)
 
-    lines = [l.strip(' ').strip('&') if not s else l for l, s in zip(lines, is_special)]
-    return [lines, pre_ampersand, ampersand_sep]
+        lines_out.append(line if special else line.strip(' ').strip('&'))
+
+    return [lines_out, pre_ampersand, ampersand_sep]
 
 
 def get_manual_alignment(lines):
     """extract manual indents for line continuations from line"""
+    first_line = lines[0]
+    first_indent = len(first_line) - len(first_line.lstrip(' ').lstrip('&'))
     manual_lines_indent = [
-        len(l) - len(l.lstrip(' ').lstrip('&')) for l in lines]
-    manual_lines_indent = [ind - manual_lines_indent[0]
-                           for ind in manual_lines_indent]
+        len(l) - len(l.lstrip(' ').lstrip('&')) - first_indent for l in lines]
     return manual_lines_indent
 
 
 def write_formatted_line(outfile, indent, lines, orig_lines, indent_special, llength, use_same_line, is_omp_conditional, label, filename, line_nr):
     """Write reformatted line to file"""
 
+    omp_prefix = '!$ ' if is_omp_conditional else ''
+    # prefix of first line, continuation lines don't get the label
+    prefix = omp_prefix + label
+    # indent used for all lines if indent_special == 1
+    same_line_indent = 1 if use_same_line else 0
+    max_length = llength + 1  # llength (default 132) plus 1 newline char
+    linesplit_message = LINESPLIT_MESSAGE + " (limit: " + str(llength) + ")"
+
+    lines_out = []
     for ind, line, orig_line in zip(indent, lines, orig_lines):
 
         # get actual line length excluding comment:
-        line_length = 0
-        for line_length, _ in CharFilter(line):
-            pass
-        line_length += 1
+        spans = filtered_spans(line)
+        if spans and spans[-1][1] == len(line):
+            line_length = max(spans[-1][0], 1)
+        else:
+            line_length = max(len(line), 1)
 
         if indent_special != 1:
             ind_use = ind
         else:
-            if use_same_line:
-                ind_use = 1
-            else:
-                ind_use = 0
+            ind_use = same_line_indent
 
         if CPP_RE.search(line.lstrip()):
             ind_use = 0
 
-        if label:
-            label_use = label
-            label = '' # no label for continuation lines
-        else:
-            label_use = ''
-
-        if ind_use + line_length <= (llength+1):  # llength (default 132) plus 1 newline char
-            outfile.write('!$ ' * is_omp_conditional + label_use +
-                          ' ' * (ind_use - 3 * is_omp_conditional - len(label_use) +
-                                 len(line) - len(line.lstrip(' '))) +
-                          line.lstrip(' '))
-        elif line_length <= (llength+1):
-            outfile.write('!$ ' * is_omp_conditional + label_use + ' ' *
-                          ((llength+1) - 3 * is_omp_conditional - len(label_use) -
-                           len(line.lstrip(' '))) + line.lstrip(' '))
-
-            log_message(LINESPLIT_MESSAGE+" (limit: "+str(llength)+")", "warning",
-                        filename, line_nr)
+        line_prefix = prefix
+        prefix = omp_prefix
+
+        line_strip = line.lstrip(' ')
+
+        if ind_use + line_length <= max_length:
+            padding = ind_use + len(line) - len(line_strip)
         else:
-            outfile.write(orig_line)
-            log_message(LINESPLIT_MESSAGE+" (limit: "+str(llength)+")", "warning",
-                        filename, line_nr)
+            log_message(linesplit_message, "warning", filename, line_nr)
+            if line_length > max_length:
+                # line too long even without indent: keep original line
+                lines_out.append(orig_line)
+                continue
+            padding = max_length - len(line_strip)
+
+        lines_out.append(line_prefix + ' ' * (padding - len(line_prefix)) + line_strip)
+
+    outfile.write(''.join(lines_out))
 
 
 def get_curr_delim(line, pos):
@@ -1888,14 +2005,18 @@ def get_curr_delim(line, pos):
 
 def set_fprettify_logger(level):
     """setup custom logger"""
-    logger = logging.getLogger('fprettify-logger')
-    logger.setLevel(level)
+    LOGGER.setLevel(level)
+    # replace handler of previous call, so that messages are not duplicated
+    for handler in list(LOGGER.handlers):
+        if handler.name == LOGGER_HANDLER_NAME:
+            LOGGER.removeHandler(handler)
     stream_handler = logging.StreamHandler()
+    stream_handler.name = LOGGER_HANDLER_NAME
     stream_handler.setLevel(level)
     formatter = logging.Formatter(
         '%(levelname)s: File %(ffilename)s, line %(fline)s\n    %(message)s')
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    LOGGER.addHandler(stream_handler)
 
 
 def log_exception(e, message):
@@ -1906,12 +2027,28 @@ def log_exception(e, message):
 def log_message(message, level, filename, line_nr):
     """log a message"""
 
-    logger = logging.getLogger('fprettify-logger')
     logger_d = {'ffilename': filename, 'fline': line_nr}
-    logger_to_use = getattr(logger, level)
+    logger_to_use = getattr(LOGGER, level)
     logger_to_use(message, extra=logger_d)
 
 
+def reformat_file_task(task):  # pragma: no cover
+    """
+    format a single file of the command line interface, task is a tuple of
+    filename, logging level and keyword arguments of `reformat_inplace`.
+    Returns False if formatting failed.
+    """
+    filename, level, kwargs = task
+    set_fprettify_logger(level)
+
+    try:
+        reformat_inplace(filename, **kwargs)
+    except FprettifyException as e:
+        log_exception(e, "Fatal error occured")
+        return False
+    return True
+
+
 def run(argv=sys.argv):  # pragma: no cover
     """Command line interface"""
 
@@ -1929,6 +2066,13 @@ def run(argv=sys.argv):  # pragma: no cover
         else:
             return None
 
+    def non_negative_int(str):
+        """helper function to convert strings to non-negative int"""
+        value = int(str)
+        if value < 0:
+            raise ValueError("negative value")
+        return value
+
     def get_config_file_list(filename):
         """helper function to create list of config files found in parent directories"""
         config_file_list = []
@@ -2023,6 +2167,8 @@ def run(argv=sys.argv):  # pragma: no cover
                             help="File or directory patterns to be excluded when searching for Fortran files to format")
         parser.add_argument('-f', '--fortran', type=str, action='append', default=[],
                             help="Overrides default fortran extensions recognized by --recursive. Repeat this option to specify more than one extension.")
+        parser.add_argument('-j', '--jobs', type=non_negative_int, default=1,
+                            help="Number of files to be formatted inplace in parallel (0: number of CPUs)")
         parser.add_argument('--version', action='version',
                             version='%(prog)s 0.3.7')
         return parser
@@ -2046,6 +2192,14 @@ def run(argv=sys.argv):  # pragma: no cover
         ws_dict['intrinsics'] = args.whitespace_intrinsics
         return ws_dict
 
+    # parsed arguments for each list of config files
+    file_args_cache = {}
+
+    # files formatted inplace are deferred to a pool of worker processes if
+    # more than one job is requested
+    parallel = args.jobs != 1
+    parallel_tasks = []
+
     # support legacy input:
     if 'stdin' in args.path and not os.path.isfile('stdin'):
         args.path = ['-' if _ == 'stdin' else _ for _ in args.path]
@@ -2096,8 +2250,13 @@ def run(argv=sys.argv):  # pragma: no cover
             filearguments = arguments
             if argparse.__name__ == "configargparse":
                 filearguments['default_config_files'] = ['~/.fprettify.rc'] + get_config_file_list(os.path.abspath(filename) if filename != '-' else os.getcwd())
-            file_argparser = get_arg_parser(filearguments)
-            file_args = file_argparser.parse_args(argv[1:])
+
+            # files with the same config files share their arguments
+            config_files = tuple(filearguments.get('default_config_files', []))
+            if config_files not in file_args_cache:
+                file_argparser = get_arg_parser(filearguments)
+                file_args_cache[config_files] = file_argparser.parse_args(argv[1:])
+            file_args = file_args_cache[config_files]
             ws_dict = build_ws_dict(file_args)
 
             case_dict = {
@@ -2117,26 +2276,40 @@ def run(argv=sys.argv):  # pragma: no cover
             else:
                 level = logging.WARNING
 
-            set_fprettify_logger(level)
-
-            try:
-                reformat_inplace(filename,
-                                 stdout=stdout,
-                                 diffonly=diffonly,
-                                 impose_indent=not file_args.disable_indent,
-                                 indent_size=file_args.indent,
-                                 strict_indent=file_args.strict_indent,
-                                 impose_whitespace=not file_args.disable_whitespace,
-                                 impose_replacements=file_args.enable_replacements,
-                                 cstyle=file_args.c_relations,
-                                 case_dict=case_dict,
-                                 whitespace=file_args.whitespace,
-                                 whitespace_dict=ws_dict,
-                                 llength=1024 if file_args.line_length == 0 else file_args.line_length,
-                                 strip_comments=file_args.strip_comments,
-                                 format_decl=file_args.enable_decl,
-                                 indent_fypp=not file_args.disable_fypp,
-                                 indent_mod=not file_args.disable_indent_mod)
-            except FprettifyException as e:
-                log_exception(e, "Fatal error occured")
+            task = (filename, level, dict(
+                stdout=stdout,
+                diffonly=diffonly,
+                impose_indent=not file_args.disable_indent,
+                indent_size=file_args.indent,
+                strict_indent=file_args.strict_indent,
+                impose_whitespace=not file_args.disable_whitespace,
+                impose_replacements=file_args.enable_replacements,
+                cstyle=file_args.c_relations,
+                case_dict=case_dict,
+                whitespace=file_args.whitespace,
+                whitespace_dict=ws_dict,
+                llength=1024 if file_args.line_length == 0 else file_args.line_length,
+                strip_comments=file_args.strip_comments,
+                format_decl=file_args.enable_decl,
+                indent_fypp=not file_args.disable_fypp,
+                indent_mod=not file_args.disable_indent_mod))
+
+            # output to stdout is written in order of the files
+            if parallel and not (stdout or diffonly):
+                parallel_tasks.append(task)
+            elif not reformat_file_task(task):
                 sys.exit(1)
+
+    if parallel_tasks:
+        import multiprocessing
+
+        # let all workers finish before exiting on failure, so that no file
+        # is left partially written
+        with multiprocessing.Pool(args.jobs or None) as pool:
+            results = [pool.apply_async(reformat_file_task, (task,))
+                       for task in parallel_tasks]
+            pool.close()
+            pool.join()
+
+        if not all(result.get() for result in results):
+            sys.exit(1)
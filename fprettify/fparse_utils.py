@@ -41,11 +41,15 @@ FYPP_CLOSE_STR = r"(}#|}\$|}@)"
 NOTFORTRAN_LINE_RE = re.compile(r"("+FYPP_LINE_STR+r"|"+CPP_STR+r"|"+COMMENT_LINE_STR+r")", RE_FLAGS)
 NOTFORTRAN_FYPP_LINE_RE = re.compile(r"("+CPP_STR+r"|"+COMMENT_LINE_STR+r")", RE_FLAGS)
 FYPP_LINE_RE = re.compile(FYPP_LINE_STR, RE_FLAGS)
+FYPP_LINE_PREFIXES = ('#!', '#:', '$:', '@:')  # same as FYPP_LINE_RE
 FYPP_WITHOUT_PREPRO_RE = re.compile(FYPP_WITHOUT_PREPRO_STR, RE_FLAGS)
 FYPP_OPEN_RE = re.compile(FYPP_OPEN_STR, RE_FLAGS)
 FYPP_CLOSE_RE = re.compile(FYPP_CLOSE_STR, RE_FLAGS)
 
 STR_OPEN_RE = re.compile(r"("+FYPP_OPEN_STR+r"|"+r"'|\"|!)", RE_FLAGS)
+# characters that may start strings, comments or preprocessor statements
+# or separate statements
+SPECIAL_CHAR_RE = re.compile(r"['\"!#$@;]", RE_FLAGS)
 CPP_RE = re.compile(CPP_STR, RE_FLAGS)
 
 class fline_parser(object):
@@ -69,7 +73,7 @@ class FprettifyException(Exception):
     """Base class for all custom exceptions"""
 
     def __init__(self, msg, filename, line_nr):
-        super(FprettifyException, self).__init__(msg)
+        super().__init__(msg)
         self.filename = filename
         self.line_nr = line_nr
 
@@ -124,53 +128,110 @@ class CharFilter(object):
 
     def __next__(self):
 
-        pos, char = next(self._it)
-
-        char2 = self._content[pos:pos+2]
+        while True:
+            pos, char = next(self._it)
+
+            # only characters that may open or close a string, a comment or
+            # a fypp expression need to be inspected together with next char
+            if not self._instring:
+                if not self._incomment and char in '#$@!"\'':
+                    char2 = self._content[pos:pos+2]
+                    if FYPP_OPEN_RE.search(char2):
+                        self._instring = char2
+                        self._infypp = True
+                    elif (self._notfortran_re.search(char2)):
+                        self._incomment = char
+                    elif char in ['"', "'"]:
+                        self._instring = char
+            else:
+                if self._infypp:
+                    if char == '}' and FYPP_CLOSE_RE.search(self._content[pos:pos+2]):
+                        self._instring = ''
+                        self._infypp = False
+                        if self._filter_strings:
+                            self.__next__()
+                            continue
 
-        if not self._instring:
-            if not self._incomment:
-                if FYPP_OPEN_RE.search(char2):
-                    self._instring = char2
-                    self._infypp = True
-                elif (self._notfortran_re.search(char2)):
-                    self._incomment = char
                 elif char in ['"', "'"]:
-                    self._instring = char
-        else:
-            if self._infypp:
-                if FYPP_CLOSE_RE.search(char2):
-                    self._instring = ''
-                    self._infypp = False
-                    if self._filter_strings:
-                        self.__next__()
-                        return self.__next__()
-
-            elif char in ['"', "'"]:
-                if self._instring == char:
-                    self._instring = ''
-                    if self._filter_strings:
-                        return self.__next__()
-
-        if self._filter_comments:
-            if self._incomment:
-                raise StopIteration
-
-        if self._filter_strings:
-            if self._instring:
-                return self.__next__()
-
-        return (pos, char)
-
-    def filter_all(self):
-        filtered_str = ''
-        for pos, char in self:
-            filtered_str += char
-        return filtered_str
+                    if self._instring == char:
+                        self._instring = ''
+                        if self._filter_strings:
+                            continue
+
+            if self._filter_comments:
+                if self._incomment:
+                    raise StopIteration
+
+            if self._filter_strings:
+                if self._instring:
+                    continue
+
+            return (pos, char)
 
     def instring(self):
         return self._instring
 
+    def incomment(self):
+        return self._incomment
+
+
+# regular expressions matching the parts of a line skipped by CharFilter
+# (inline fypp expressions, comments and strings, in this order of precedence)
+FYPP_INLINE_STR = r"(?P<fypp>[#$@]\{(?:.*?\}(?=[#$@])|.*))"
+STRING_STR = r"(?P<string>'[^']*'?|\"[^\"]*\"?)"
+NOTCODE_RE = re.compile(FYPP_INLINE_STR + r"|(?P<comment>(?:#!|#:|\$:|@:|#[^!:{}]|!).*)|" +
+                        STRING_STR, re.DOTALL)
+NOTCODE_FYPP_RE = re.compile(FYPP_INLINE_STR + r"|(?P<comment>(?:#[^!:{}]|!).*)|" +
+                             STRING_STR, re.DOTALL)
+
+
+def filtered_spans(string, filter_strings=True, filter_fypp=True):
+    """
+    Return list of (start, end) tuples of all (non-overlapping, non-adjacent)
+    substrings of `string` that are skipped by `CharFilter`.
+    """
+    notcode_re = NOTCODE_RE if filter_fypp else NOTCODE_FYPP_RE
+
+    spans = []
+    fypp_close = -1
+    for match in notcode_re.finditer(string):
+        start, end = match.span()
+        if fypp_close >= 0 and start != fypp_close:
+            # closing char of a fypp expression that does not open a new one
+            spans[-1][1] += 1
+        fypp_close = -1
+
+        if match.lastgroup == 'comment' or filter_strings:
+            if spans and spans[-1][1] == start:
+                spans[-1][1] = end
+            else:
+                spans.append([start, end])
+            if match.lastgroup == 'fypp' and end < len(string):
+                fypp_close = end
+
+    if fypp_close >= 0:
+        spans[-1][1] += 1
+
+    return [tuple(span) for span in spans]
+
+
+def mask_line(string, filter_strings=True, filter_fypp=True, fill=' '):
+    """
+    Return a copy of `string` of the same length in which all characters that
+    are skipped by `CharFilter` (comments and, optionally, strings) are
+    replaced by `fill`. Positions of the remaining characters are preserved
+    unless `fill` is empty, in which case skipped characters are removed.
+    """
+    masked = []
+    pos_prev = 0
+    for start, end in filtered_spans(string, filter_strings, filter_fypp):
+        masked += [string[pos_prev:start], fill * (end - start)]
+        pos_prev = end
+
+    masked.append(string[pos_prev:])
+    return ''.join(masked)
+
+
 class InputStream(object):
     """Class to read logical Fortran lines from a Fortran file."""
 
@@ -226,29 +287,39 @@ class InputStream(object):
                 if string_iter.instring() and not line.lstrip().startswith('&'):
                     line = '&' + line
 
-                # update instead of CharFilter(line) to account for multiline strings
-                string_iter.update(line)
-                for pos, char in string_iter:
-                    if char == ';' or pos + 1 == len(line):
-                        self.endpos.append(pos - line_start)
-                        self.line_buffer.append(line[line_start:pos + 1])
-                        self.what_omp.append(what_omp)
-                        what_omp = ''
-                        line_start = pos + 1
-
-                if pos + 1 < len(line):
-                   if fypp_cont:
-                       self.endpos.append(-1)
-                       self.line_buffer.append(line)
-                       self.what_omp.append(what_omp)
-                   else:
-                       for pos_add, char in CharFilter(line[pos+1:], filter_comments=False):
-                           char2 = line[pos+1+pos_add:pos+3+pos_add]
-                           if self.notfortran_re.search(char2):
-                               self.endpos.append(pos + pos_add - line_start)
-                               self.line_buffer.append(line[line_start:])
-                               self.what_omp.append(what_omp)
-                               break
+                if (line and not SPECIAL_CHAR_RE.search(line) and
+                        not string_iter.instring() and not string_iter.incomment()):
+                    # plain code line, no need to filter it character-wise
+                    self.endpos.append(len(line) - 1)
+                    self.line_buffer.append(line)
+                    self.what_omp.append(what_omp)
+                else:
+                    # update instead of CharFilter(line) to account for multiline strings
+                    string_iter.update(line)
+                    for pos, char in string_iter:
+                        if char == ';' or pos + 1 == len(line):
+                            self.endpos.append(pos - line_start)
+                            self.line_buffer.append(line[line_start:pos + 1])
+                            self.what_omp.append(what_omp)
+                            what_omp = ''
+                            line_start = pos + 1
+
+                    if pos + 1 < len(line):
+                       if fypp_cont:
+                           self.endpos.append(-1)
+                           self.line_buffer.append(line)
+                           self.what_omp.append(what_omp)
+                       else:
+                           for pos_add, char in CharFilter(line[pos+1:], filter_comments=False):
+                               # comments and directives start with one of these
+                               if char not in '!#$@':
+                                   continue
+                               char2 = line[pos+1+pos_add:pos+3+pos_add]
+                               if self.notfortran_re.search(char2):
+                                   self.endpos.append(pos + pos_add - line_start)
+                                   self.line_buffer.append(line[line_start:])
+                                   self.what_omp.append(what_omp)
+                                   break
 
                 if not self.line_buffer:
                     self.endpos.append(len(line))
@@ -19,9 +19,6 @@
 ###############################################################################
 
 """Dynamically create tests based on examples in examples/before."""
-from __future__ import (absolute_import, division,
-                        print_function, unicode_literals)
-
 import sys
 import os
 import unittest
@@ -32,12 +29,14 @@ import re
 import difflib
 import subprocess
 import inspect
+import tempfile
 
 sys.stderr = io.TextIOWrapper(
     sys.stderr.detach(), encoding='UTF-8', line_buffering=True)
 
 import fprettify
-from fprettify.fparse_utils import FprettifyParseException, FprettifyInternalException
+from fprettify.fparse_utils import (FprettifyParseException, FprettifyInternalException,
+                                    CharFilter, filtered_spans, mask_line)
 
 
 def joinpath(path1, path2):
@@ -295,6 +294,84 @@ class FPrettifyTestCase(unittest.TestCase):
         else:
             os.remove(alien_file)
 
+    def test_replace_file(self):
+        """test replacing file contents atomically or, where needed, in place"""
+        instring = "CALL  alien_invasion( x )"
+        outstring_exp = "CALL alien_invasion(x)"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            alien_file = joinpath(tmpdir, "alien_invasion.f90")
+            alien_link = joinpath(tmpdir, "alien_invasion_link.f90")
+            alien_tmp = alien_file + ".fprettify.tmp"
+            readonly_dir = joinpath(tmpdir, "readonly")
+            readonly_file = joinpath(readonly_dir, "alien_invasion.f90")
+
+            # replaced atomically: mode is kept, existing files are not touched
+            with io.open(alien_file, 'w', encoding='utf-8') as infile:
+                infile.write(instring)
+            with io.open(alien_tmp, 'w', encoding='utf-8') as infile:
+                infile.write(instring)
+            os.chmod(alien_file, 0o640)
+            fprettify.replace_file_contents(alien_file, outstring_exp)
+            with io.open(alien_file, 'r', encoding='utf-8') as infile:
+                self.assertEqual(outstring_exp, infile.read())
+            with io.open(alien_tmp, 'r', encoding='utf-8') as infile:
+                self.assertEqual(instring, infile.read())
+            self.assertEqual(os.stat(alien_file).st_mode & 0o777, 0o640)
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ["alien_invasion.f90", "alien_invasion.f90.fprettify.tmp"])
+
+            # written in place: hard links are kept
+            with io.open(alien_file, 'w', encoding='utf-8') as infile:
+                infile.write(instring)
+            os.link(alien_file, alien_link)
+            inode = os.stat(alien_file).st_ino
+            fprettify.replace_file_contents(alien_file, outstring_exp)
+            self.assertEqual(os.stat(alien_file).st_ino, inode)
+            with io.open(alien_link, 'r', encoding='utf-8') as infile:
+                self.assertEqual(outstring_exp, infile.read())
+
+            # written in place: no temporary file can be created in directory
+            os.mkdir(readonly_dir)
+            with io.open(readonly_file, 'w', encoding='utf-8') as infile:
+                infile.write(instring)
+            os.chmod(readonly_dir, 0o555)
+            try:
+                fprettify.replace_file_contents(readonly_file, outstring_exp)
+                self.assertEqual(os.listdir(readonly_dir), ["alien_invasion.f90"])
+            finally:
+                os.chmod(readonly_dir, 0o755)
+            with io.open(readonly_file, 'r', encoding='utf-8') as infile:
+                self.assertEqual(outstring_exp, infile.read())
+
+    def test_jobs(self):
+        """test formatting of several files in parallel"""
+
+        instring = "CALL  alien_invasion( x )"
+        outstring_exp = "CALL alien_invasion(x)"
+
+        alien_files = ["alien_invasion_1.f90", "alien_invasion_2.f90"]
+        for alien_file in alien_files:
+            if os.path.isfile(alien_file):
+                raise AlienInvasion(
+                    "remove file " + alien_file)  # pragma: no cover
+
+        try:
+            for alien_file in alien_files:
+                with io.open(alien_file, 'w', encoding='utf-8') as infile:
+                    infile.write(instring)
+
+            p1 = subprocess.Popen([RUNSCRIPT, '-j', '2'] + alien_files)
+            self.assertEqual(p1.wait(), 0)
+
+            for alien_file in alien_files:
+                with io.open(alien_file, 'r', encoding='utf-8') as infile:
+                    self.assertEqual(outstring_exp, infile.read().strip())
+        finally:
+            for alien_file in alien_files:
+                if os.path.isfile(alien_file):
+                    os.remove(alien_file)
+
     def test_multi_alias(self):
         """test for issue #11 (multiple alias and alignment)"""
         instring="use A,only:B=>C,&\nD=>E"
@@ -773,6 +850,10 @@ ${worktype}$, &
         self.assert_fprettify_result(['--enable-decl'], instring_2, outstring_2)
         self.assert_fprettify_result(['--enable-decl', '--whitespace-decl=0'], instring_2, outstring_2_min)
 
+        # repeated '::' (invalid Fortran) used to fail at finding line break positions
+        self.assert_fprettify_result(['--enable-decl'], "integer ::: a", "integer :: :a")
+        self.assert_fprettify_result(['--enable-decl'], "integer :: :: a", "integer :: :: a")
+
     def test_statement_label(self):
         instring = "1003  FORMAT(2(1x, i4), 5x, '-', 5x, '-', 3x, '-', 5x, '-', 5x, '-', 8x, '-', 3x, &\n    1p, 2(1x, d10.3))"
         outstring = "1003  FORMAT(2(1x, i4), 5x, '-', 5x, '-', 3x, '-', 5x, '-', 5x, '-', 8x, '-', 3x, &\n             1p, 2(1x, d10.3))"
@@ -842,6 +923,41 @@ ${worktype}$, &
         for instr, outstr in zip(instring, outstring):
             self.assert_fprettify_result([], instr, outstr)
 
+    def test_filtered_spans(self):
+        """test that filtered_spans and mask_line skip the same characters as CharFilter"""
+        instrings = [
+            "x = 1",
+            "x = 'a!b' ! comment",
+            'x = "it\'s" // \'say "hi"\' ! "comment"',
+            "x = 'unterminated ! string",
+            'x = "unterminated',
+            "call f(${a}$, @{b}@) ! ${c}$",
+            "y = ${a}$${b}$ + #{if x}#z#{endif}#",
+            "y = ${a + ${b}$}$ + ${c",
+            "#:if defined('X')",
+            "#!fypp comment 'a'",
+            "$: f(x)",
+            "@:assert(x)",
+            "#ifdef X",
+            "x = '#:a' // \"${b}$\" // '!'",
+            "!! doc 'string'",
+            "x = 1 # a ! b",
+            "",
+        ]
+
+        for instring in instrings:
+            for filter_strings in (True, False):
+                for filter_fypp in (True, False):
+                    kept = [pos for pos, _ in CharFilter(
+                        instring, filter_strings=filter_strings, filter_fypp=filter_fypp)]
+                    spans = filtered_spans(instring, filter_strings, filter_fypp)
+                    kept_spans = [pos for pos in range(len(instring))
+                                  if not any(start <= pos < end for start, end in spans)]
+                    self.assertEqual(kept, kept_spans, repr(instring))
+
+                    masked = mask_line(instring, filter_strings, filter_fypp, fill='')
+                    self.assertEqual(''.join(instring[pos] for pos in kept), masked, repr(instring))
+
     def test_label(self):
         instring = \
 """